@@ -0,0 +1,333 @@
+# bulk_research.py
+"""
+Resumable batch pipeline: image directory -> topic -> Wikipedia summary.
+
+Streams over a directory tree and runs the same tool functions the MCP
+servers expose (extract_main_topic_from_image, fetch_wikipedia_summary)
+with separate concurrency limits per stage. Bounded queues between the
+stages keep memory flat regardless of corpus size.
+
+Results are appended to a JSONL file, one line per image. The file doubles
+as the checkpoint: on restart, images already recorded as "ok" are skipped,
+so a killed run resumes where it stopped. Images whose Wikipedia lookup
+failed after the vision stage found a topic go straight back to the
+Wikipedia stage instead of paying for the vision call again.
+
+Usage:
+    python bulk_research.py /data/photos -o results.jsonl \
+        --vision-concurrency 4 --wiki-concurrency 8
+"""
+import argparse
+import asyncio
+import contextvars
+import itertools
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from rate_limiter import Priority, current_priority, get_scheduler
+from research_server import fetch_wikipedia_summary
+from visual_analysis_server import extract_main_topic_from_image
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp"}
+
+# Paths pulled from the directory walk per worker-thread hop.
+WALK_BATCH = 256
+
+_DONE = object()
+
+
+def run_in(executor: Executor, fn, *args):
+    """
+    Like asyncio.to_thread, but on a stage's own executor so the stage's
+    concurrency limit is real; contextvars (current_priority) are carried over.
+    """
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(executor, context.run, fn, *args)
+
+
+# ------------------------------------------------------------------
+# INPUT / CHECKPOINT
+# ------------------------------------------------------------------
+def iter_images(root: str, extensions: Set[str]) -> Iterator[str]:
+    """
+    Lazily walks the tree in a stable order, one directory at a time.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if os.path.splitext(name)[1].lower() in extensions:
+                yield os.path.abspath(os.path.join(dirpath, name))
+
+
+def load_completed(output_path: str) -> Tuple[Set[str], Dict[str, str]]:
+    """
+    Returns the paths already recorded as successful, and {path: topic} for
+    images that only failed in the Wikipedia stage. A torn last line from a
+    killed run is ignored, so that image is simply processed again.
+    """
+    completed = set()
+    topics = {}
+    if not os.path.exists(output_path):
+        return completed, topics
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("status") == "ok":
+                completed.add(record["path"])
+                topics.pop(record["path"], None)
+            elif record.get("topic"):
+                topics[record["path"]] = record["topic"]
+    return completed, topics
+
+
+class ResultWriter:
+    """
+    Append-only JSONL writer. Every line is flushed; every `checkpoint_every`
+    lines are fsynced so at most that many results are lost on a crash.
+    """
+
+    def __init__(self, path: str, checkpoint_every: int):
+        self._f = open(path, "a", encoding="utf-8")
+        # Terminate a torn line left by a previous crash.
+        if self._f.tell() > 0:
+            with open(path, "rb") as existing:
+                existing.seek(-1, os.SEEK_END)
+                if existing.read(1) != b"\n":
+                    self._f.write("\n")
+        self._checkpoint_every = checkpoint_every
+        self._pending = 0
+
+    def write(self, record: Dict[str, Any]) -> None:
+        self._f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._f.flush()
+        self._pending += 1
+        if self._pending >= self._checkpoint_every:
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._pending = 0
+
+    def close(self) -> None:
+        self.checkpoint()
+        self._f.close()
+
+
+# ------------------------------------------------------------------
+# PROGRESS
+# ------------------------------------------------------------------
+class Progress:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.skipped = 0
+        self.ok = 0
+        self.failed = 0
+        self.vision_done = 0
+
+    def line(self) -> str:
+        elapsed = time.monotonic() - self.start
+        processed = self.ok + self.failed
+        rate = processed / elapsed if elapsed > 0 else 0.0
+        return (
+            f"[{elapsed:7.1f}s] ok={self.ok} failed={self.failed} "
+            f"skipped={self.skipped} vision={self.vision_done} "
+            f"throughput={rate:.2f} img/s"
+        )
+
+
+async def report_progress(progress: Progress, interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        print("\r" + progress.line(), end="", file=sys.stderr, flush=True)
+
+
+# ------------------------------------------------------------------
+# PIPELINE STAGES
+# ------------------------------------------------------------------
+def _next_batch(images: Iterator[str]) -> List[str]:
+    return list(itertools.islice(images, WALK_BATCH))
+
+
+async def produce(root: str, extensions: Set[str], completed: Set[str],
+                  known_topics: Dict[str, str], paths: asyncio.Queue,
+                  topics: asyncio.Queue, progress: Progress, vision_workers: int) -> None:
+    # Topic already known from a previous run: only the lookup is retried.
+    for path, topic in known_topics.items():
+        await topics.put((path, topic))
+
+    images = iter_images(root, extensions)
+    while True:
+        # os.walk blocks on large trees; keep it off the event loop.
+        batch = await asyncio.to_thread(_next_batch, images)
+        if not batch:
+            break
+        for path in batch:
+            if path in completed:
+                progress.skipped += 1
+                continue
+            if path in known_topics:
+                continue
+            # Blocks when the vision stage is saturated (backpressure).
+            await paths.put(path)
+    for _ in range(vision_workers):
+        await paths.put(_DONE)
+
+
+async def vision_worker(paths: asyncio.Queue, topics: asyncio.Queue,
+                        results: asyncio.Queue, progress: Progress,
+                        executor: Executor) -> None:
+    while True:
+        path = await paths.get()
+        if path is _DONE:
+            return
+        topic = await run_in(executor, extract_main_topic_from_image, path)
+        progress.vision_done += 1
+        if not topic or topic.startswith("Error"):
+            await results.put({"path": path, "status": "error", "error": topic or "empty topic"})
+        else:
+            await topics.put((path, topic))
+
+
+class SummaryCache:
+    """
+    Small LRU of Wikipedia results by topic; photo archives tend to contain
+    many shots of the same landmark.
+    """
+
+    def __init__(self, executor: Executor, maxsize: int = 1024):
+        self._executor = executor
+        self._data: "OrderedDict[str, asyncio.Future]" = OrderedDict()
+        self._maxsize = maxsize
+
+    async def get(self, topic: str) -> Dict[str, Any]:
+        key = topic.strip().lower()
+        future = self._data.get(key)
+        if future is None:
+            future = run_in(self._executor, fetch_wikipedia_summary, topic)
+            self._data[key] = future
+            if len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+        else:
+            self._data.move_to_end(key)
+        result = await asyncio.shield(future)
+        if "error" in result:
+            # Do not pin transient failures in the cache.
+            self._data.pop(key, None)
+        return result
+
+
+async def wiki_worker(topics: asyncio.Queue, results: asyncio.Queue,
+                      cache: SummaryCache) -> None:
+    while True:
+        item = await topics.get()
+        if item is _DONE:
+            return
+        path, topic = item
+        summary = await cache.get(topic)
+        if "error" in summary:
+            await results.put({"path": path, "topic": topic, "status": "error",
+                               "error": summary["error"]})
+        else:
+            await results.put({"path": path, "topic": topic, "status": "ok", **summary})
+
+
+async def write_results(results: asyncio.Queue, writer: ResultWriter,
+                        progress: Progress) -> None:
+    while True:
+        record = await results.get()
+        if record is _DONE:
+            return
+        writer.write(record)
+        if record["status"] == "ok":
+            progress.ok += 1
+        else:
+            progress.failed += 1
+
+
+# ------------------------------------------------------------------
+# RUNNER
+# ------------------------------------------------------------------
+async def run(root: str, output: str, vision_concurrency: int, wiki_concurrency: int,
+              checkpoint_every: int, progress_interval: float,
+              extensions: Optional[Set[str]] = None) -> Progress:
+    # Bulk jobs queue behind interactive Gradio traffic in the scheduler
+    # state shared by all processes; run_in carries this into the tool calls.
+    current_priority.set(Priority.BULK)
+
+    extensions = extensions or IMAGE_EXTENSIONS
+    completed, known_topics = load_completed(output)
+    writer = ResultWriter(output, checkpoint_every)
+    progress = Progress()
+
+    paths: asyncio.Queue = asyncio.Queue(maxsize=vision_concurrency * 2)
+    topics: asyncio.Queue = asyncio.Queue(maxsize=wiki_concurrency * 2)
+    results: asyncio.Queue = asyncio.Queue(maxsize=(vision_concurrency + wiki_concurrency) * 2)
+    vision_pool = ThreadPoolExecutor(vision_concurrency, thread_name_prefix="vision")
+    wiki_pool = ThreadPoolExecutor(wiki_concurrency, thread_name_prefix="wiki")
+    cache = SummaryCache(wiki_pool)
+
+    reporter = asyncio.create_task(report_progress(progress, progress_interval))
+    writer_task = asyncio.create_task(write_results(results, writer, progress))
+    try:
+        vision = [asyncio.create_task(vision_worker(paths, topics, results, progress, vision_pool))
+                  for _ in range(vision_concurrency)]
+        wiki = [asyncio.create_task(wiki_worker(topics, results, cache))
+                for _ in range(wiki_concurrency)]
+
+        await produce(root, extensions, completed, known_topics, paths, topics,
+                      progress, vision_concurrency)
+        await asyncio.gather(*vision)
+        for _ in range(wiki_concurrency):
+            await topics.put(_DONE)
+        await asyncio.gather(*wiki)
+        await results.put(_DONE)
+        await writer_task
+    finally:
+        reporter.cancel()
+        writer.close()
+        vision_pool.shutdown(wait=False, cancel_futures=True)
+        wiki_pool.shutdown(wait=False, cancel_futures=True)
+
+    print("\r" + progress.line(), file=sys.stderr)
+    return progress
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk image topic + Wikipedia research")
+    parser.add_argument("root", help="Directory tree of images to process")
+    parser.add_argument("-o", "--output", default="bulk_results.jsonl",
+                        help="Append-only JSONL results file (also the resume checkpoint)")
+    parser.add_argument("--vision-concurrency", type=int, default=4)
+    parser.add_argument("--wiki-concurrency", type=int, default=8)
+    parser.add_argument("--checkpoint-every", type=int, default=50,
+                        help="fsync the results file every N records")
+    parser.add_argument("--progress-interval", type=float, default=2.0)
+    args = parser.parse_args()
+
+    progress = asyncio.run(run(
+        args.root,
+        args.output,
+        args.vision_concurrency,
+        args.wiki_concurrency,
+        args.checkpoint_every,
+        args.progress_interval,
+    ))
+    print(f"✅ Done. {progress.ok} ok, {progress.failed} failed, "
+          f"{progress.skipped} already complete.")
+    # The scheduler state is shared, so these cover every bulk run and
+    # process since the state file was created, not only this run.
+    print(f"📊 OpenAI queue waits (bulk priority, all runs): "
+          f"{get_scheduler().metrics()['wait']['bulk']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+# image_ingest.py
+"""
+Memory-bounded image ingestion for vision requests.
+
+The naive path keeps the raw bytes, the base64 bytes, the decoded str, the
+data URL and finally the serialized JSON body in memory at once (~5x the
+file size). Here the JSON request body is produced as a stream instead:
+the file is read in fixed-size chunks into one reusable buffer and each
+chunk is base64-encoded as it is sent, so a request holds O(chunk) bytes no
+matter how large the image is. The body length is known up front, so it can
+still be sent with a Content-Length header.
+
+On top of that, an in-flight byte budget admits requests only while the
+total size of bodies being sent stays under a limit; requests queue for a
+bounded time and are rejected after that. The vision tool runs in a fresh
+MCP server process per call, so the budget lives in a shared state file
+(see shared_state.py) rather than in process memory. A per-request size
+cap rejects oversized images before any bytes are read.
+"""
+import binascii
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from shared_state import SharedState, state_path
+
+# Multiple of 3 so chunk boundaries never produce base64 padding mid-stream.
+CHUNK_SIZE = 3 * 64 * 1024
+
+# Put this string where the image data URL goes in the request payload.
+IMAGE_PLACEHOLDER = "__IMAGE_DATA_URL__"
+
+# Room for the JSON envelope (prompt, model, ...) around the image data.
+_ENVELOPE_ALLOWANCE = 16 * 1024
+
+
+class IngestRejected(Exception):
+    """Raised when an image exceeds the size cap or cannot be admitted in time."""
+
+
+def encoded_size(n: int) -> int:
+    return 4 * ((n + 2) // 3)
+
+
+def max_body_bytes(image_bytes: int) -> int:
+    """Request body size for the largest image that should be accepted."""
+    return encoded_size(image_bytes) + _ENVELOPE_ALLOWANCE
+
+
+# ------------------------------------------------------------------
+# STREAMING REQUEST BODY
+# ------------------------------------------------------------------
+def _iter_base64(path: str, size: int) -> Iterator[bytes]:
+    """
+    Yields the base64 encoding of the file one chunk at a time, reading into
+    a single reusable buffer.
+    """
+    raw_view = memoryview(bytearray(CHUNK_SIZE))
+    remaining = size
+    with open(path, "rb", buffering=0) as f:
+        while remaining > 0:
+            n = f.readinto(raw_view[:min(CHUNK_SIZE, remaining)])
+            if not n:
+                raise IngestRejected(f"{path} shrank while being read")
+            remaining -= n
+            yield binascii.b2a_base64(raw_view[:n], newline=False)
+
+
+def build_vision_body(path: str, mime_type: str, payload: Dict) -> Tuple[int, Iterator[bytes]]:
+    """
+    Returns (content_length, body_chunks) for a JSON request body in which the
+    IMAGE_PLACEHOLDER string inside `payload` is replaced by the image's
+    data URL. Only the small JSON envelope is ever serialized in one piece.
+    """
+    size = os.path.getsize(path)
+    envelope = json.dumps(payload)
+    marker = json.dumps(IMAGE_PLACEHOLDER)
+    if envelope.count(marker) != 1:
+        raise ValueError("payload must contain the image placeholder exactly once")
+    head, tail = envelope.split(marker)
+    prefix = (head + f'"data:{mime_type};base64,').encode("utf-8")
+    suffix = ('"' + tail).encode("utf-8")
+    length = len(prefix) + encoded_size(size) + len(suffix)
+
+    def chunks() -> Iterator[bytes]:
+        yield prefix
+        yield from _iter_base64(path, size)
+        yield suffix
+
+    return length, chunks()
+
+
+# ------------------------------------------------------------------
+# ADMISSION CONTROL
+# ------------------------------------------------------------------
+def _pid_alive(pid: int) -> bool:
+    if os.name == "nt":
+        # os.kill(pid, 0) sends CTRL_C_EVENT on Windows instead of probing.
+        # Holders are then only released explicitly, like the single-process
+        # setup the fcntl fallback in shared_state.py is meant for.
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ByteBudget:
+    """
+    Global in-flight bytes budget, shared by every process using `path`.
+    Requests wait FIFO until their bytes fit, and are rejected if that takes
+    longer than `timeout` seconds.
+
+    Holders are recorded with their pid, so bytes held by a process that
+    died mid-request are reclaimed; waiters refresh a heartbeat while they
+    poll and are dropped once it goes stale.
+    """
+
+    def __init__(self, path: Path, limit_bytes: int, max_request_bytes: int,
+                 poll_interval: float = 0.02):
+        self.limit_bytes = limit_bytes
+        self.max_request_bytes = min(max_request_bytes, limit_bytes)
+        self.poll_interval = poll_interval
+        self.stale_after = max(5.0, poll_interval * 50)
+        self._state = SharedState(path, lambda: {
+            "seq": 0,
+            "holders": {},
+            "waiting": {},
+            "peak_in_flight": 0,
+            "rejected": 0,
+        })
+
+    @staticmethod
+    def _in_flight(state: Dict[str, Any]) -> int:
+        holders = state["holders"]
+        for ticket, (_, pid, _) in list(holders.items()):
+            if not _pid_alive(pid):
+                del holders[ticket]
+        return sum(n for n, _, _ in holders.values())
+
+    def acquire(self, n: int, timeout: Optional[float] = None) -> str:
+        """
+        Blocks until `n` bytes fit in the budget. Returns a ticket for release().
+        """
+        if n > self.max_request_bytes:
+            with self._state.update() as state:
+                state["rejected"] += 1
+            raise IngestRejected(
+                f"Image request is {n} bytes, limit is {self.max_request_bytes} bytes"
+            )
+        deadline = None if timeout is None else time.time() + timeout
+        ticket = uuid.uuid4().hex
+
+        with self._state.update() as state:
+            seq = state["seq"]
+            state["seq"] += 1
+            state["waiting"][ticket] = [seq, time.time()]
+
+        try:
+            while True:
+                with self._state.update() as state:
+                    now = time.time()
+                    waiting = state["waiting"]
+                    for other, (_, heartbeat) in list(waiting.items()):
+                        if other != ticket and now - heartbeat > self.stale_after:
+                            del waiting[other]
+                    waiting[ticket] = [seq, now]
+
+                    in_flight = self._in_flight(state)
+                    head = min(waiting, key=lambda t: waiting[t][0])
+                    if head == ticket and in_flight + n <= self.limit_bytes:
+                        del waiting[ticket]
+                        state["holders"][ticket] = [n, os.getpid(), now]
+                        state["peak_in_flight"] = max(state["peak_in_flight"], in_flight + n)
+                        return ticket
+                    timed_out = deadline is not None and now >= deadline
+                    if timed_out:
+                        # Raised outside the block so the state is written back.
+                        del waiting[ticket]
+                        state["rejected"] += 1
+                if timed_out:
+                    raise IngestRejected(
+                        f"Too many images in flight ({in_flight} bytes), try again later"
+                    )
+                time.sleep(self.poll_interval)
+        except BaseException:
+            with self._state.update() as state:
+                state["waiting"].pop(ticket, None)
+            raise
+
+    def release(self, ticket: str) -> None:
+        with self._state.update() as state:
+            state["holders"].pop(ticket, None)
+
+    @contextmanager
+    def reserve(self, n: int, timeout: Optional[float] = None):
+        ticket = self.acquire(n, timeout)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+    def metrics(self) -> Dict[str, int]:
+        with self._state.update() as state:
+            return {
+                "in_flight": self._in_flight(state),
+                "peak_in_flight": state["peak_in_flight"],
+                "rejected": state["rejected"],
+            }
+
+
+_budget: Optional[ByteBudget] = None
+_budget_lock = threading.Lock()
+
+
+def get_budget() -> ByteBudget:
+    """
+    Returns the budget shared by all processes of the app, configured from
+    VISION_INFLIGHT_MB (total request bytes in flight) and VISION_MAX_IMAGE_MB
+    (per-image cap).
+    """
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            _budget = ByteBudget(
+                state_path("vision_inflight.json"),
+                limit_bytes=int(os.getenv("VISION_INFLIGHT_MB", "256")) * 1024 * 1024,
+                max_request_bytes=max_body_bytes(int(os.getenv("VISION_MAX_IMAGE_MB", "20")) * 1024 * 1024),
+            )
+        return _budget
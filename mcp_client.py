@@ -1,15 +1,20 @@
 # mcp_client.py
 import asyncio
 import os
+import time
 from typing import Annotated
 
 import gradio as gr
 from dotenv import load_dotenv
 from typing_extensions import TypedDict
 
-from langchain_core.messages import AnyMessage, ToolMessage, HumanMessage
+import json
+
+from langchain_core.messages import AnyMessage, AIMessage, ToolMessage, HumanMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.tools import StructuredTool
 from langchain_openai import ChatOpenAI
+from openai import APIConnectionError, InternalServerError, RateLimitError
 
 from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import START, END, StateGraph
@@ -18,6 +23,10 @@ from langgraph.prebuilt import tools_condition, ToolNode
 
 from langchain_mcp_adapters.client import MultiServerMCPClient
 
+from rate_limiter import MAX_RETRIES, Priority, estimate_tokens, get_scheduler, retry_backoff
+from prefetch import VISION_TOOL, WIKIPEDIA_TOOL, WikipediaPrefetcher
+from upload_store import get_store
+
 
 # ------------------------------------------------------------------
 # ENV SETUP (LOCAL + PRODUCTION SAFE)
@@ -71,6 +80,8 @@ def extract_text_from_mcp_result(result):
     """
     Handles all known MCP response formats and safely extracts text.
     """
+    if isinstance(result, ToolMessage):
+        result = result.content
     if isinstance(result, list):
         for item in result:
             if isinstance(item, dict):
@@ -109,15 +120,58 @@ class FixedToolNode(ToolNode):
             )
 
 
+# ------------------------------------------------------------------
+# WIKIPEDIA PREFETCH
+# ------------------------------------------------------------------
+def with_prefetch(tools: list, prefetcher: WikipediaPrefetcher) -> list:
+    """
+    Replaces the vision and Wikipedia tools with wrappers that prefetch the
+    lookup as soon as the topic is known (see prefetch.py). Wrapping the
+    tools instead of overriding ToolNode internals keeps this independent of
+    the langgraph version.
+    """
+    by_name = {tool.name: tool for tool in tools}
+    if VISION_TOOL not in by_name or WIKIPEDIA_TOOL not in by_name:
+        return tools
+
+    def text_of(tool):
+        async def run(args):
+            return extract_text_from_mcp_result(await tool.ainvoke(args))
+        return run
+
+    def as_tool(original, run):
+        async def coroutine(**kwargs):
+            return await run(kwargs)
+        return StructuredTool(
+            name=original.name,
+            description=original.description,
+            args_schema=original.args_schema,
+            coroutine=coroutine,
+        )
+
+    vision, wikipedia = prefetcher.wrap(
+        text_of(by_name[VISION_TOOL]), text_of(by_name[WIKIPEDIA_TOOL])
+    )
+    wrapped = {
+        VISION_TOOL: as_tool(by_name[VISION_TOOL], vision),
+        WIKIPEDIA_TOOL: as_tool(by_name[WIKIPEDIA_TOOL], wikipedia),
+    }
+    return [wrapped.get(tool.name, tool) for tool in tools]
+
+
 # ------------------------------------------------------------------
 # GRAPH CREATION
 # ------------------------------------------------------------------
-def create_graph(tools: list):
+def create_graph(tools: list, prefetcher: WikipediaPrefetcher):
+    tools = with_prefetch(tools, prefetcher)
 
     llm = ChatOpenAI(
         model="gpt-4o-mini",
         temperature=0,
         api_key=OPENAI_API_KEY,
+        include_response_headers=True,
+        # Retries go through the scheduler in chat_node, not the SDK behind it.
+        max_retries=0,
     )
 
     llm_with_tools = llm.bind_tools(tools)
@@ -128,8 +182,8 @@ def create_graph(tools: list):
             "system",
             "You are an agentic AI system.\n"
             "You MUST follow this workflow strictly:\n"
-            "1. If user mentions an image path, call the vision tool to extract the main topic.\n"
-            "2. Then call the Wikipedia tool using that topic.\n"
+            "1. If user mentions an image ID or image path, call the vision tool to extract the main topic.\n"
+            "2. Then call the Wikipedia tool using that topic, passing the user's question as context.\n"
             "3. Return a fact-based explanation using Wikipedia data only.\n"
             "Do NOT skip steps. Do NOT hallucinate. Always use tools."
         ),
@@ -138,8 +192,38 @@ def create_graph(tools: list):
 
     chat_llm = prompt | llm_with_tools
 
+    scheduler = get_scheduler()
+
     def chat_node(state: State):
-        response = chat_llm.invoke({"messages": state["messages"]})
+        # Planner turns serve the Gradio user directly, so they always
+        # jump ahead of bulk work queued on the same OpenAI account.
+        prompt_text = "".join(str(m.content) for m in state["messages"])
+        estimate = estimate_tokens(prompt_text) + 500
+
+        for attempt in range(MAX_RETRIES + 1):
+            reserved = scheduler.acquire(estimate, Priority.INTERACTIVE)
+            try:
+                response = chat_llm.invoke({"messages": state["messages"]})
+                break
+            except RateLimitError as e:
+                scheduler.settle(reserved, 0)
+                scheduler.record_rate_limited(e.response.headers)
+                if attempt == MAX_RETRIES:
+                    raise
+            except (APIConnectionError, InternalServerError):
+                # Connection errors, timeouts and 5xx: what the SDK retried
+                # before max_retries=0.
+                scheduler.settle(reserved, 0)
+                if attempt == MAX_RETRIES:
+                    raise
+                time.sleep(retry_backoff(attempt))
+            except Exception:
+                scheduler.settle(reserved, 0)
+                raise
+
+        scheduler.update_from_headers(response.response_metadata.get("headers"))
+        usage = response.usage_metadata or {}
+        scheduler.settle(reserved, usage.get("total_tokens"))
         return {"messages": [response]}
 
     tool_node = FixedToolNode(tools)
@@ -168,6 +252,9 @@ def create_graph(tools: list):
 # ------------------------------------------------------------------
 # AGENT SETUP (RUNS ONCE)
 # ------------------------------------------------------------------
+prefetcher = WikipediaPrefetcher()
+
+
 async def setup_agent():
     print("🚀 Initializing MCP Client & Tools...")
     client = MultiServerMCPClient(server_configs)
@@ -177,7 +264,7 @@ async def setup_agent():
     for tool in tools:
         print(f"  - {tool.name}")
 
-    agent = create_graph(tools)
+    agent = create_graph(tools, prefetcher)
     print("🤖 Agent is READY")
     return agent
 
@@ -185,6 +272,57 @@ async def setup_agent():
 agent = asyncio.run(setup_agent())
 
 
+# ------------------------------------------------------------------
+# LLM TURN TRACKING
+# ------------------------------------------------------------------
+turn_stats = {"requests": 0, "llm_turns": 0, "local_resolutions": 0}
+
+
+def record_turns(messages: list) -> None:
+    """
+    Counts planner turns for the latest request and how many Wikipedia
+    lookups the research server resolved locally. Each local resolution
+    replaces at least one extra planner turn spent re-querying.
+    """
+    last_human = max(
+        (i for i, m in enumerate(messages) if isinstance(m, HumanMessage)),
+        default=-1,
+    )
+    current = messages[last_human + 1:]
+
+    turns = sum(isinstance(m, AIMessage) for m in current)
+    resolutions = 0
+    for m in current:
+        if isinstance(m, ToolMessage) and m.name == WIKIPEDIA_TOOL:
+            # Raw MCP content may be a list of content blocks.
+            try:
+                data = json.loads(extract_text_from_mcp_result(m.content))
+            except ValueError:
+                continue
+            resolutions += isinstance(data, dict) and "resolved_from" in data
+
+    turn_stats["requests"] += 1
+    turn_stats["llm_turns"] += turns
+    turn_stats["local_resolutions"] += resolutions
+    print(
+        f"📊 LLM turns: {turns} (measured avg "
+        f"{turn_stats['llm_turns'] / turn_stats['requests']:.2f}/request over "
+        f"{turn_stats['requests']} requests), Wikipedia lookups resolved locally: "
+        f"{resolutions} (estimate: >= {turn_stats['local_resolutions']} planner "
+        f"turns saved in total, one per local resolution)"
+    )
+
+
+def report_prefetch(stats: dict) -> None:
+    totals = prefetcher.totals
+    print(
+        f"⚡ Wikipedia prefetch: {stats['hits']}/{stats['started']} hits, "
+        f"{stats['saved_s']:.2f}s saved, {stats['cancelled']} cancelled "
+        f"(overall hit rate {WikipediaPrefetcher.hit_rate(totals):.0%}, "
+        f"avg {totals['saved_s'] / totals['requests']:.2f}s saved/request)"
+    )
+
+
 # ------------------------------------------------------------------
 # GRADIO UI
 # ------------------------------------------------------------------
@@ -211,13 +349,25 @@ with gr.Blocks(theme=gr.themes.Default(primary_hue="blue")) as demo:
             chat_history = []
 
         # Build user message
+        image_id = None
         if image_path:
-            full_image_path = os.path.abspath(image_path)
-            full_message = f"{user_text}\n\nImage path: {full_image_path}"
             chat_history.append({
                 "role": "user",
-                "content": f"📷 {image_path}\n{user_text}"
+                "content": f"📷 {os.path.basename(image_path)}\n{user_text}"
             })
+            # Hash + dedupe once; tools get the opaque ID, and the Gradio
+            # temp copy is dropped instead of accumulating on disk.
+            try:
+                image_id = await asyncio.to_thread(get_store().put_file, image_path)
+            except Exception as e:
+                chat_history.append({"role": "assistant", "content": f"❌ Error: {str(e)}"})
+                return "", chat_history, None
+            finally:
+                try:
+                    os.remove(image_path)
+                except OSError:
+                    pass
+            full_message = f"{user_text}\n\nImage ID: {image_id}"
         else:
             full_message = user_text
             chat_history.append({
@@ -235,11 +385,16 @@ with gr.Blocks(theme=gr.themes.Default(primary_hue="blue")) as demo:
                 config={"configurable": {"thread_id": "gradio-session"}}
             )
 
+            record_turns(result["messages"])
             last_message = result["messages"][-1]
             bot_reply = last_message.content if last_message.content else "⚠️ No response generated."
 
         except Exception as e:
             bot_reply = f"❌ Error: {str(e)}"
+        finally:
+            if image_id:
+                await asyncio.to_thread(get_store().release, image_id)
+            report_prefetch(prefetcher.finish())
 
         chat_history.append({
             "role": "assistant",
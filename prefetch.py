@@ -0,0 +1,131 @@
+# prefetch.py
+"""
+Speculative Wikipedia prefetch.
+
+As soon as the vision tool returns a topic, the Wikipedia lookup for that
+topic is started in the background, in parallel with the planner turn that
+would otherwise have to finish before the lookup even begins. When the
+planner then calls fetch_wikipedia_summary with the same query, the result
+is taken from the in-flight (or already finished) prefetch. Prefetches the
+planner never asks for are cancelled at the end of the request.
+"""
+import asyncio
+import json
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+VISION_TOOL = "extract_main_topic_from_image"
+WIKIPEDIA_TOOL = "fetch_wikipedia_summary"
+
+
+def _normalize(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+def _empty_stats() -> Dict[str, Any]:
+    return {"requests": 0, "started": 0, "hits": 0, "cancelled": 0, "saved_s": 0.0}
+
+
+class _Prefetch:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+        task.add_done_callback(self._done)
+
+    def _done(self, _task) -> None:
+        self.finished = time.monotonic()
+
+
+class WikipediaPrefetcher:
+    def __init__(self):
+        self._pending: Dict[str, _Prefetch] = {}
+        self.totals = _empty_stats()
+        self._request = _empty_stats()
+
+    def start(self, topic: str, fetch: Callable[[Dict[str, Any]], Awaitable[str]]) -> None:
+        """
+        Starts fetch({"query": topic}) in the background unless already running.
+        """
+        key = _normalize(topic)
+        if not key or key in self._pending:
+            return
+        self._pending[key] = _Prefetch(asyncio.create_task(fetch({"query": topic})))
+        self._request["started"] += 1
+
+    async def claim(self, args: Dict[str, Any]) -> Optional[str]:
+        """
+        Returns the prefetched result for a planner tool call, or None if the
+        call has to go to the server (no prefetch, failure, or a result that
+        depended on a context hint the prefetch did not have).
+        """
+        entry = self._pending.pop(_normalize(args.get("query", "")), None)
+        if entry is None:
+            return None
+        requested_at = time.monotonic()
+        try:
+            text = await entry.task
+        except Exception:
+            return None
+
+        try:
+            data = json.loads(text)
+        except (TypeError, ValueError):
+            data = {}
+        if not isinstance(data, dict) or "error" in data:
+            return None
+        if "resolved_from" in data and args.get("context"):
+            # Ambiguous title: the planner's context may pick a different page.
+            return None
+
+        # Time the lookup had already been running when the planner asked.
+        self._request["hits"] += 1
+        self._request["saved_s"] += min(requested_at, entry.finished or requested_at) - entry.started
+        return text
+
+    def finish(self) -> Dict[str, Any]:
+        """
+        Cancels unused prefetches and returns this request's stats.
+        """
+        for entry in self._pending.values():
+            if entry.task.done():
+                if not entry.task.cancelled():
+                    entry.task.exception()  # mark any failure as retrieved
+            else:
+                entry.task.cancel()
+            self._request["cancelled"] += 1
+        self._pending.clear()
+
+        request, self._request = self._request, _empty_stats()
+        request["requests"] = 1
+        for k, v in request.items():
+            self.totals[k] += v
+        return request
+
+    def wrap(self, run_vision: Callable[[Dict[str, Any]], Awaitable[str]],
+             run_wikipedia: Callable[[Dict[str, Any]], Awaitable[str]]
+             ) -> Tuple[Callable[[Dict[str, Any]], Awaitable[str]],
+                        Callable[[Dict[str, Any]], Awaitable[str]]]:
+        """
+        Wraps the two tool calls (async args -> text): the vision call starts
+        a prefetch for the topic it found, the Wikipedia call claims it.
+        """
+        async def vision(args: Dict[str, Any]) -> str:
+            text = await run_vision(args)
+            # Start the Wikipedia lookup now instead of after the next
+            # planner turn, which will almost always ask for it.
+            if text and not text.startswith("Error"):
+                self.start(text.strip(), run_wikipedia)
+            return text
+
+        async def wikipedia(args: Dict[str, Any]) -> str:
+            prefetched = await self.claim(args)
+            if prefetched is not None:
+                return prefetched
+            return await run_wikipedia(args)
+
+        return vision, wikipedia
+
+    @staticmethod
+    def hit_rate(stats: Dict[str, Any]) -> float:
+        return stats["hits"] / stats["started"] if stats["started"] else 0.0
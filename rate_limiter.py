@@ -0,0 +1,395 @@
+# rate_limiter.py
+"""
+Rate-limit-aware priority scheduler for OpenAI calls.
+
+Every OpenAI request (planner turns in mcp_client, vision calls in
+visual_analysis_server, bulk jobs) acquires a slot here before it is sent.
+Two token buckets track the requests-per-minute and tokens-per-minute
+budgets; they are re-synced from the x-ratelimit-* response headers so they
+follow what the account actually has left.
+
+The buckets, the wait queue and the metrics live in a shared state file
+(see shared_state.py), so the Gradio client, the short-lived MCP server
+subprocesses and bulk_research all wait in one queue. Waiting requests are
+served strictly by priority (interactive before bulk) and FIFO within a
+priority class. Waiters refresh a heartbeat while they poll; entries from
+processes that died while waiting are dropped once it goes stale.
+"""
+import contextvars
+import logging
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from enum import IntEnum
+from pathlib import Path
+from typing import Any, Dict, Mapping, Optional
+
+from shared_state import SharedState, state_path
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BULK = 1
+
+
+# Callers that cannot pass a priority explicitly (e.g. MCP tools invoked
+# through asyncio.to_thread) inherit it from the calling context.
+current_priority: contextvars.ContextVar[Priority] = contextvars.ContextVar(
+    "openai_priority", default=Priority.INTERACTIVE
+)
+
+
+# Retries after a 429 or a transient failure (connection error, timeout,
+# 5xx), each going back through acquire(). The OpenAI clients are created
+# with max_retries=0 so they never retry behind the scheduler.
+MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+
+
+class RateLimitTimeout(Exception):
+    """Raised when a request could not be scheduled within its timeout."""
+
+
+# ------------------------------------------------------------------
+# HELPERS
+# ------------------------------------------------------------------
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """
+    Parses OpenAI reset headers such as "1s", "6m0s" or "20ms" into seconds.
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_RE.findall(value)
+    if not parts:
+        return None
+    return sum(float(n) * _DURATION_UNITS[unit] for n, unit in parts)
+
+
+def retry_backoff(attempt: int) -> float:
+    """
+    Delay before retrying a transient failure: exponential from 0.5s up to
+    8s with jitter, like the OpenAI SDK's own retries.
+    """
+    return min(8.0, 0.5 * 2 ** attempt) * random.uniform(0.75, 1.0)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap token estimate (~4 characters per token) used to reserve budget
+    before the real usage is known.
+    """
+    return max(1, len(text) // 4)
+
+
+def _header(headers: Mapping[str, Any], name: str) -> Optional[str]:
+    value = headers.get(name)
+    if value is None:
+        value = headers.get(name.title())
+    return None if value is None else str(value)
+
+
+# ------------------------------------------------------------------
+# TOKEN BUCKET
+# ------------------------------------------------------------------
+class TokenBucket:
+    """
+    Classic token bucket over wall-clock time (comparable across processes).
+    Not thread-safe on its own; the scheduler guards it.
+    """
+
+    def __init__(self, capacity: float, window: float = 60.0):
+        self.capacity = float(capacity)
+        self.window = float(window)
+        self.refill_per_sec = self.capacity / self.window
+        self.level = float(capacity)
+        self.updated = time.time()
+
+    def to_dict(self) -> Dict[str, float]:
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, float]) -> "TokenBucket":
+        bucket = cls.__new__(cls)
+        vars(bucket).update(data)
+        return bucket
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.level = min(self.capacity, self.level + elapsed * self.refill_per_sec)
+            self.updated = now
+
+    def time_until(self, amount: float, now: float) -> float:
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.refill_per_sec
+
+    def consume(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+
+    def refund(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+    def sync(self, limit: Optional[float], remaining: Optional[float],
+             reset_seconds: Optional[float], now: float) -> None:
+        """
+        Adapts the bucket to what the server reports. The server is the
+        source of truth for remaining budget, so the local level is never
+        allowed to exceed it.
+        """
+        self._refill(now)
+        if limit:
+            self.capacity = float(limit)
+            self.refill_per_sec = self.capacity / self.window
+        if remaining is not None:
+            self.level = min(self.level, float(remaining), self.capacity)
+            if reset_seconds and reset_seconds > 0 and remaining < self.capacity:
+                # The server refills the deficit over reset_seconds; never
+                # refill faster than that locally.
+                observed = (self.capacity - remaining) / reset_seconds
+                self.refill_per_sec = min(self.capacity / self.window, max(observed, 1e-6))
+            else:
+                self.refill_per_sec = self.capacity / self.window
+
+    def drain(self, now: float) -> None:
+        self._refill(now)
+        self.level = min(self.level, 0.0)
+
+
+# ------------------------------------------------------------------
+# QUEUE-WAIT METRICS
+# ------------------------------------------------------------------
+_RECENT_WAITS = 200
+
+
+def _empty_wait_stats() -> Dict[str, Any]:
+    return {"count": 0, "total": 0.0, "max": 0.0, "recent": []}
+
+
+def _record_wait(stats: Dict[str, Any], waited: float) -> None:
+    stats["count"] += 1
+    stats["total"] += waited
+    stats["max"] = max(stats["max"], waited)
+    stats["recent"] = (stats["recent"] + [waited])[-_RECENT_WAITS:]
+
+
+def _wait_snapshot(stats: Dict[str, Any]) -> Dict[str, float]:
+    recent = sorted(stats["recent"])
+    p95 = recent[min(len(recent) - 1, int(len(recent) * 0.95))] if recent else 0.0
+    return {
+        "count": stats["count"],
+        "mean_wait_s": stats["total"] / stats["count"] if stats["count"] else 0.0,
+        "p95_wait_s": p95,
+        "max_wait_s": stats["max"],
+    }
+
+
+# ------------------------------------------------------------------
+# SCHEDULER
+# ------------------------------------------------------------------
+class RateLimitScheduler:
+    """
+    Cross-process priority scheduler over RPM and TPM token buckets.
+
+    Usage:
+        reserved = scheduler.acquire(estimated_tokens)
+        ... send request ...
+        scheduler.update_from_headers(response_headers)
+        scheduler.settle(reserved, actual_tokens)
+    """
+
+    def __init__(self, path: Path, requests_per_minute: int, tokens_per_minute: int,
+                 window: float = 60.0, poll_interval: float = 0.05):
+        self.poll_interval = poll_interval
+        # Waiters heartbeat on every poll; a much older heartbeat means the
+        # waiting process is gone.
+        self.stale_after = max(5.0, poll_interval * 50)
+        self._state = SharedState(path, lambda: {
+            "requests": TokenBucket(requests_per_minute, window).to_dict(),
+            "tokens": TokenBucket(tokens_per_minute, window).to_dict(),
+            "paused_until": 0.0,
+            "seq": 0,
+            "waiting": {},
+            "rate_limited": 0,
+            "wait": {p.name.lower(): _empty_wait_stats() for p in Priority},
+        })
+
+    def acquire(self, tokens: int, priority: Optional[Priority] = None,
+                timeout: Optional[float] = None) -> int:
+        """
+        Blocks until the request may be sent. Returns the number of tokens
+        reserved, to be passed back to settle() once real usage is known.
+        """
+        if priority is None:
+            priority = current_priority.get()
+        tokens = max(1, int(tokens))
+        start = time.time()
+        deadline = None if timeout is None else start + timeout
+        ticket = uuid.uuid4().hex
+
+        with self._state.update() as state:
+            seq = state["seq"]
+            state["seq"] += 1
+            state["waiting"][ticket] = [int(priority), seq, start]
+
+        try:
+            while True:
+                with self._state.update() as state:
+                    now = time.time()
+                    waiting = state["waiting"]
+                    for other, (_, _, heartbeat) in list(waiting.items()):
+                        if other != ticket and now - heartbeat > self.stale_after:
+                            del waiting[other]
+                    waiting[ticket] = [int(priority), seq, now]
+
+                    head = min(waiting, key=lambda t: (waiting[t][0], waiting[t][1]))
+                    if head == ticket:
+                        requests = TokenBucket.from_dict(state["requests"])
+                        budget = TokenBucket.from_dict(state["tokens"])
+                        delay = max(
+                            state["paused_until"] - now,
+                            requests.time_until(1, now),
+                            budget.time_until(tokens, now),
+                        )
+                        if delay <= 0:
+                            requests.consume(1, now)
+                            budget.consume(tokens, now)
+                            state["requests"] = requests.to_dict()
+                            state["tokens"] = budget.to_dict()
+                            del waiting[ticket]
+                            _record_wait(state["wait"][priority.name.lower()], now - start)
+                            return tokens
+                        # Re-check regularly: another process may sync headers
+                        # or hit a 429 in the meantime.
+                        delay = min(delay, self.poll_interval * 5)
+                    else:
+                        delay = self.poll_interval
+
+                if deadline is not None:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise RateLimitTimeout(
+                            f"{priority.name.lower()} request waited {now - start:.1f}s"
+                        )
+                    delay = min(delay, remaining)
+                time.sleep(delay)
+        except BaseException:
+            with self._state.update() as state:
+                state["waiting"].pop(ticket, None)
+            raise
+
+    def settle(self, reserved: int, actual_tokens: Optional[int]) -> None:
+        """
+        Corrects the token bucket once the real usage of a request is known.
+        Pass 0 for requests that failed before being served.
+        """
+        if actual_tokens is None:
+            return
+        diff = reserved - int(actual_tokens)
+        if diff == 0:
+            return
+        with self._state.update() as state:
+            now = time.time()
+            budget = TokenBucket.from_dict(state["tokens"])
+            if diff > 0:
+                budget.refund(diff, now)
+            else:
+                budget.consume(-diff, now)
+            state["tokens"] = budget.to_dict()
+
+    def update_from_headers(self, headers: Optional[Mapping[str, Any]]) -> None:
+        """
+        Re-syncs both buckets from x-ratelimit-* response headers.
+        """
+        if not headers:
+            return
+
+        def number(name: str) -> Optional[float]:
+            value = _header(headers, name)
+            try:
+                return float(value) if value is not None else None
+            except ValueError:
+                return None
+
+        with self._state.update() as state:
+            now = time.time()
+            for key, kind in (("requests", "requests"), ("tokens", "tokens")):
+                bucket = TokenBucket.from_dict(state[key])
+                bucket.sync(
+                    number(f"x-ratelimit-limit-{kind}"),
+                    number(f"x-ratelimit-remaining-{kind}"),
+                    parse_reset_duration(_header(headers, f"x-ratelimit-reset-{kind}")),
+                    now,
+                )
+                state[key] = bucket.to_dict()
+
+    def record_rate_limited(self, headers: Optional[Mapping[str, Any]] = None) -> None:
+        """
+        Called after a 429: pauses all traffic until the server's retry hint
+        (or one second) has passed and empties both buckets.
+        """
+        headers = headers or {}
+        retry_after = (
+            parse_reset_duration(_header(headers, "retry-after"))
+            or parse_reset_duration(_header(headers, "x-ratelimit-reset-requests"))
+            or 1.0
+        )
+        with self._state.update() as state:
+            now = time.time()
+            state["rate_limited"] += 1
+            state["paused_until"] = max(state["paused_until"], now + retry_after)
+            for key in ("requests", "tokens"):
+                bucket = TokenBucket.from_dict(state[key])
+                bucket.drain(now)
+                state[key] = bucket.to_dict()
+        logger.warning("OpenAI rate limit hit, pausing for %.2fs", retry_after)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._state.update() as state:
+            return {
+                "queued": len(state["waiting"]),
+                "rate_limited": state["rate_limited"],
+                "requests_available": state["requests"]["level"],
+                "tokens_available": state["tokens"]["level"],
+                "wait": {name: _wait_snapshot(s) for name, s in state["wait"].items()},
+            }
+
+
+# ------------------------------------------------------------------
+# SHARED SCHEDULER
+# ------------------------------------------------------------------
+_scheduler: Optional[RateLimitScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> RateLimitScheduler:
+    """
+    Returns the scheduler shared by all processes of the app, configured from
+    OPENAI_RPM_LIMIT and OPENAI_TPM_LIMIT (used when the shared state file is
+    first created; response headers take over from there).
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RateLimitScheduler(
+                state_path("openai_rate_limits.json"),
+                requests_per_minute=int(os.getenv("OPENAI_RPM_LIMIT", "500")),
+                tokens_per_minute=int(os.getenv("OPENAI_TPM_LIMIT", "200000")),
+            )
+        return _scheduler
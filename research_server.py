@@ -1,23 +1,104 @@
 # wikipedia_server.py
+import re
 import wikipedia
+from difflib import SequenceMatcher
 from mcp.server.fastmcp import FastMCP
-from typing import Dict, Any
+from typing import Dict, Any, List
 import logging
 
 mcp = FastMCP("WikipediaSearch")
 
+# How many ranked candidates to try fetching, and how many to return as
+# alternates, when a query is ambiguous or has no exact page.
+MAX_CANDIDATE_FETCHES = 3
+MAX_ALTERNATES = 5
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def _words(text: str) -> set:
+    # Crude plural folding so "Pyramids" matches "pyramid".
+    return {w[:-1] if len(w) > 3 and w.endswith("s") else w
+            for w in _WORD_RE.findall(text.lower()) if len(w) > 2}
+
+
+def _score(candidate: str, query: str, context: str) -> float:
+    """
+    Ranks a candidate title by string similarity to the query, word overlap
+    with the query (Jaccard, so a short title matching one query word does
+    not count as a full match) and a smaller bonus for title words that only
+    the caller-supplied context hint mentions.
+    """
+    similarity = SequenceMatcher(None, query.lower(), candidate.lower()).ratio()
+    candidate_words = _words(candidate)
+    if not candidate_words:
+        return similarity
+    query_words = _words(query)
+    overlap = len(candidate_words & query_words) / len(candidate_words | query_words)
+    context_words = _words(context) - query_words
+    hinted = 0.5 * len(candidate_words & context_words) / len(candidate_words)
+    score = similarity + overlap + hinted
+    if "disambiguation" in candidate.lower():
+        score -= 1.0
+    return score
+
+
+def rank_candidates(candidates: List[str], query: str, context: str = "") -> List[str]:
+    unique = list(dict.fromkeys(c for c in candidates if c))
+    # Wikipedia lists the most common meaning first; keep that as a small
+    # prior so it wins when neither the query nor the context decides.
+    prior = {c: 0.2 * (1 - i / len(unique)) for i, c in enumerate(unique)}
+    return sorted(unique, key=lambda c: _score(c, query, context) + prior[c], reverse=True)
+
+
+def _page_result(page) -> Dict[str, Any]:
+    return {
+        "title": page.title,
+        "summary": page.summary.split("\n")[0],
+        "url": page.url
+    }
+
+
+def _resolve_locally(query: str, context: str, candidates: List[str],
+                     resolution: str) -> Dict[str, Any]:
+    """
+    Fetches the best-ranked candidate in the same tool call, so the planner
+    does not spend extra turns guessing new queries.
+    """
+    ranked = rank_candidates(candidates, query, context)
+    for title in ranked[:MAX_CANDIDATE_FETCHES]:
+        try:
+            page = wikipedia.page(title, auto_suggest=False)
+        except (wikipedia.exceptions.DisambiguationError,
+                wikipedia.exceptions.PageError):
+            continue
+        result = _page_result(page)
+        result["resolved_from"] = query
+        result["resolution"] = resolution
+        result["alternates"] = [t for t in ranked if t != title][:MAX_ALTERNATES]
+        return result
+    return {
+        "error": f"No unambiguous Wikipedia page found for '{query}'",
+        "alternates": ranked[:MAX_ALTERNATES],
+    }
+
+
 @mcp.tool()
-def fetch_wikipedia_summary(query: str) -> Dict[str, Any]:
+def fetch_wikipedia_summary(query: str, context: str = "") -> Dict[str, Any]:
     """
     Returns title, summary and url of the best matching Wikipedia page.
+    Ambiguous or missing titles are resolved here by ranking the candidate
+    pages against the query and the optional context (e.g. the image topic
+    or the user's question); other close matches are listed in "alternates".
     """
     try:
-        page = wikipedia.page(query, auto_suggest=True)
-        return {
-            "title": page.title,
-            "summary": page.summary.split("\n")[0],
-            "url": page.url
-        }
+        try:
+            page = wikipedia.page(query, auto_suggest=True)
+            return _page_result(page)
+        except wikipedia.exceptions.DisambiguationError as e:
+            return _resolve_locally(query, context, e.options, "disambiguation")
+        except wikipedia.exceptions.PageError:
+            return _resolve_locally(query, context, wikipedia.search(query, results=10), "search")
     except Exception as e:
         return {"error": str(e)}
 
@@ -0,0 +1,73 @@
+# shared_state.py
+"""
+Small JSON state files shared by every process of the app.
+
+The Gradio client, the MCP server subprocesses (started fresh for each tool
+call) and bulk_research all run as separate processes, so budgets that must
+be global (OpenAI rate limits, in-flight image bytes) live in a file guarded
+by an exclusive file lock instead of in process memory.
+"""
+import contextlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process local development only
+    fcntl = None
+
+BASE_DIR = Path(__file__).parent.resolve()
+
+
+def state_path(name: str) -> Path:
+    """
+    Location of a named state file, under SHARED_STATE_DIR.
+    """
+    root = Path(os.getenv("SHARED_STATE_DIR", BASE_DIR / ".shared_state"))
+    return root / name
+
+
+@contextlib.contextmanager
+def file_lock(path: Path):
+    """
+    Holds an exclusive flock on `path` (created if missing) for the block.
+    """
+    with open(path, "a") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class SharedState:
+    def __init__(self, path: Path, initial: Callable[[], Dict[str, Any]]):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock_path = self.path.with_name(self.path.name + ".lock")
+        self._initial = initial
+        # flock excludes other processes; this excludes other threads.
+        self._thread_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def update(self):
+        """
+        Yields the current state dict under the lock and writes it back
+        when the block exits without an exception.
+        """
+        with self._thread_lock, file_lock(self._lock_path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    state = json.load(f)
+            except (FileNotFoundError, ValueError):
+                state = self._initial()
+            yield state
+            tmp = self.path.with_name(self.path.name + f".{os.getpid()}.tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            os.replace(tmp, self.path)
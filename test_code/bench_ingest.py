@@ -0,0 +1,142 @@
+# bench_ingest.py
+"""
+tracemalloc benchmark: peak Python memory per vision request for the old
+in-memory data-URL path vs the streaming body from image_ingest.
+
+Each request body is fully produced and discarded (as the HTTP client would
+send it), so the numbers cover building the request, not the network.
+
+Run from the repo root:
+    python test_code/bench_ingest.py [image_mb]
+"""
+import base64
+import json
+import os
+import sys
+import tempfile
+import threading
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_ingest import (
+    IMAGE_PLACEHOLDER, ByteBudget, IngestRejected, build_vision_body, max_body_bytes,
+)
+
+CONCURRENCY = 32
+MB = 1024 * 1024
+
+
+def payload(image_url):
+    return {
+        "model": "gpt-4.1-mini",
+        "input": [{
+            "role": "user",
+            "content": [
+                {"type": "input_text", "text": "Identify the main topic."},
+                {"type": "input_image", "image_url": image_url},
+            ],
+        }],
+        "max_output_tokens": 50,
+    }
+
+
+def legacy_request(path):
+    """What extract_main_topic_from_image + the OpenAI SDK used to hold."""
+    with open(path, "rb") as f:
+        image_data = f.read()
+    base64_image = base64.b64encode(image_data).decode("utf-8")
+    image_data_url = f"data:image/jpeg;base64,{base64_image}"
+    body = json.dumps(payload(image_data_url)).encode("utf-8")
+    return len(body)
+
+
+def streaming_request(path, budget=None):
+    length, chunks = build_vision_body(path, "image/jpeg", payload(IMAGE_PLACEHOLDER))
+    if budget is None:
+        return sum(len(c) for c in chunks)
+    with budget.reserve(length, timeout=60):
+        return sum(len(c) for c in chunks)
+
+
+def measure(fn, paths, concurrent):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    errors = []
+
+    def run(p):
+        try:
+            fn(p)
+        except IngestRejected as e:
+            errors.append(e)
+
+    if concurrent:
+        # Release every thread at once so all bodies are built concurrently.
+        barrier = threading.Barrier(len(paths))
+
+        def run_together(p):
+            barrier.wait()
+            run(p)
+
+        threads = [threading.Thread(target=run_together, args=(p,)) for p in paths]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    else:
+        run(paths[0])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, errors
+
+
+def main():
+    image_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 8
+    size = int(image_mb * MB)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"📦 Writing {CONCURRENCY} random images of {image_mb:g} MB...")
+        paths = []
+        for i in range(CONCURRENCY):
+            p = os.path.join(tmp, f"img{i}.jpg")
+            with open(p, "wb") as f:
+                f.write(os.urandom(size))
+            paths.append(p)
+
+        print("=" * 60)
+        print(f"{'scenario':<40}{'peak MB':>10}{'x file':>10}")
+        print("=" * 60)
+
+        def row(name, peak):
+            print(f"{name:<40}{peak / MB:>10.1f}{peak / size:>10.2f}")
+
+        peak, _ = measure(legacy_request, paths, concurrent=False)
+        row("legacy, 1 request", peak)
+        peak, _ = measure(streaming_request, paths, concurrent=False)
+        row("streaming, 1 request", peak)
+
+        peak, _ = measure(legacy_request, paths, concurrent=True)
+        row(f"legacy, {CONCURRENCY} concurrent", peak)
+        peak, _ = measure(streaming_request, paths, concurrent=True)
+        row(f"streaming, {CONCURRENCY} concurrent", peak)
+
+        # Admission control: only ~4 bodies' worth of bytes may be in flight.
+        budget = ByteBudget(os.path.join(tmp, "budget.json"),
+                            limit_bytes=4 * max_body_bytes(size), max_request_bytes=max_body_bytes(size))
+        peak, errors = measure(lambda p: streaming_request(p, budget), paths, concurrent=True)
+        row(f"streaming + budget, {CONCURRENCY} concurrent", peak)
+        print("=" * 60)
+        stats = budget.metrics()
+        print(f"Budget: peak in-flight {stats['peak_in_flight'] / MB:.1f} MB "
+              f"of {budget.limit_bytes / MB:.1f} MB, rejected={len(errors)}")
+
+        small = ByteBudget(os.path.join(tmp, "small.json"),
+                           limit_bytes=64 * MB, max_request_bytes=max_body_bytes(size // 2))
+        try:
+            streaming_request(paths[0], small)
+        except IngestRejected as e:
+            print(f"Per-request cap: {e}")
+
+
+if __name__ == "__main__":
+    main()
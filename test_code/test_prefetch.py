@@ -0,0 +1,78 @@
+# test_prefetch.py
+"""
+Checks prefetch.WikipediaPrefetcher.wrap against stand-in tools: a vision
+call followed by a Wikipedia call for the same query must be served from the
+prefetch, and a prefetch the planner never asks for must be cancelled.
+No network or API key needed.
+
+Run from the repo root:
+    python test_code/test_prefetch.py
+"""
+import asyncio
+import json
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prefetch import WikipediaPrefetcher
+
+VISION_LATENCY = 0.05
+PLANNER_LATENCY = 0.2
+WIKIPEDIA_LATENCY = 0.3
+
+
+def stand_in_tools(topic):
+    calls = []
+
+    async def run_vision(args):
+        await asyncio.sleep(VISION_LATENCY)
+        return topic
+
+    async def run_wikipedia(args):
+        calls.append(args["query"])
+        await asyncio.sleep(WIKIPEDIA_LATENCY)
+        return json.dumps({"title": args["query"], "summary": "...", "url": "..."})
+
+    return run_vision, run_wikipedia, calls
+
+
+async def request(prefetcher, topic, planner_query):
+    run_vision, run_wikipedia, calls = stand_in_tools(topic)
+    vision, wikipedia = prefetcher.wrap(run_vision, run_wikipedia)
+
+    found = await vision({"image_id": "img_0"})
+    await asyncio.sleep(PLANNER_LATENCY)  # planner turn choosing the next tool
+    await wikipedia({"query": planner_query or found, "context": "history"})
+    return prefetcher.finish(), calls
+
+
+def check(name, ok):
+    print(f"{'✓' if ok else '✗'} {name}")
+    return ok
+
+
+async def main():
+    print("⚡ Testing Wikipedia prefetch...\n")
+    prefetcher = WikipediaPrefetcher()
+    results = []
+
+    stats, calls = await request(prefetcher, "Eiffel Tower", None)
+    results.append(check(f"same query is a hit ({stats['hits']}/{stats['started']})",
+                         stats["hits"] == 1 and stats["started"] == 1))
+    results.append(check(f"Wikipedia fetched once ({len(calls)} calls)", len(calls) == 1))
+    results.append(check(f"latency saved ~{PLANNER_LATENCY}s ({stats['saved_s']:.2f}s)",
+                         stats["saved_s"] >= PLANNER_LATENCY * 0.8))
+
+    stats, calls = await request(prefetcher, "Eiffel Tower", "Gustave Eiffel")
+    results.append(check(f"different query is a miss ({stats['hits']}/{stats['started']})",
+                         stats["hits"] == 0 and stats["started"] == 1))
+    results.append(check(f"unused prefetch cancelled ({stats['cancelled']})",
+                         stats["cancelled"] == 1))
+
+    print(f"\nOverall hit rate: {WikipediaPrefetcher.hit_rate(prefetcher.totals):.0%}")
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
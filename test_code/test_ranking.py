@@ -0,0 +1,54 @@
+# test_ranking.py
+"""
+Checks research_server.rank_candidates on ambiguous / missing titles.
+No network needed: only the ranking is exercised, not the Wikipedia API.
+
+Run from the repo root:
+    python test_code/test_ranking.py
+"""
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from research_server import rank_candidates
+
+# (query, context, candidates as Wikipedia lists them, expected best)
+CASES = [
+    ("Statue of Liberty New York", "",
+     ["Liberty", "Statue of Liberty National Monument", "Statue of Liberty (disambiguation)"],
+     "Statue of Liberty National Monument"),
+    ("Pyramids of Giza", "",
+     ["Giza", "Giza pyramid complex", "Pyramids (band)"],
+     "Giza pyramid complex"),
+    ("Mercury", "the planet closest to the sun",
+     ["Freddie Mercury", "Mercury (element)", "Mercury (planet)"],
+     "Mercury (planet)"),
+    ("Mercury", "Queen singer Freddie",
+     ["Mercury (planet)", "Mercury (element)", "Freddie Mercury"],
+     "Freddie Mercury"),
+    ("Mercury", "",
+     ["Mercury (planet)", "Mercury (element)", "Freddie Mercury"],
+     "Mercury (planet)"),
+    ("Big Ben", "clock tower in London",
+     ["Ben", "Big Ben", "Big (film)"],
+     "Big Ben"),
+]
+
+
+def main():
+    print("🔎 Testing Wikipedia candidate ranking...\n")
+    failures = 0
+    for query, context, candidates, expected in CASES:
+        best = rank_candidates(candidates, query, context)[0]
+        ok = best == expected
+        failures += not ok
+        hint = f" (context: {context})" if context else ""
+        print(f"{'✓' if ok else '✗'} {query}{hint} -> {best}"
+              + ("" if ok else f", expected {expected}"))
+    print(f"\n{len(CASES) - failures}/{len(CASES)} passed")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+# test_rate_limiter.py
+"""
+Demo of rate_limiter.RateLimitScheduler against a local stand-in that
+enforces RPM/TPM limits the way the OpenAI API does (429 + x-ratelimit-*
+headers). No network or API key needed.
+
+Bulk workers run in a separate process (like bulk_research.py) and the
+interactive user in this one (like the Gradio client). Both the stand-in
+and the scheduler keep their state in shared files, so the two processes
+share one account budget and one priority queue.
+
+Run from the repo root:
+    python test_code/test_rate_limiter.py
+"""
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rate_limiter import Priority, RateLimitScheduler
+from shared_state import SharedState
+
+# One "minute" is compressed to 6 seconds: 60 requests / 30k tokens per window.
+WINDOW = 6.0
+RPM = 60
+TPM = 30000
+BULK_WORKERS = 6
+
+
+class RateLimitedStandIn:
+    """
+    Enforces RPM/TPM the way the OpenAI API does: budgets replenish
+    continuously over the window, and every response carries the
+    x-ratelimit-* headers. State is shared by every process using `path`.
+    """
+
+    def __init__(self, path: Path, rpm: int, tpm: int, window: float = 60.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = window
+        self._state = SharedState(path, lambda: {
+            "requests": float(rpm), "tokens": float(tpm), "updated": time.time(),
+            "accepted": 0, "rejected": 0,
+        })
+
+    def _headers(self, state):
+        reset_requests = (self.rpm - state["requests"]) * self.window / self.rpm
+        reset_tokens = (self.tpm - state["tokens"]) * self.window / self.tpm
+        return {
+            "x-ratelimit-limit-requests": str(self.rpm),
+            "x-ratelimit-remaining-requests": str(int(state["requests"])),
+            "x-ratelimit-reset-requests": f"{reset_requests:.3f}s",
+            "x-ratelimit-limit-tokens": str(self.tpm),
+            "x-ratelimit-remaining-tokens": str(int(state["tokens"])),
+            "x-ratelimit-reset-tokens": f"{reset_tokens:.3f}s",
+        }
+
+    def create(self, tokens: int):
+        time.sleep(0.02)  # network + model latency
+        with self._state.update() as state:
+            now = time.time()
+            elapsed = now - state["updated"]
+            state["requests"] = min(self.rpm, state["requests"] + elapsed * self.rpm / self.window)
+            state["tokens"] = min(self.tpm, state["tokens"] + elapsed * self.tpm / self.window)
+            state["updated"] = now
+            if state["requests"] < 1 or state["tokens"] < tokens:
+                state["rejected"] += 1
+                headers = self._headers(state)
+                headers["retry-after"] = "0.5"
+                return 429, headers
+            state["requests"] -= 1
+            state["tokens"] -= tokens
+            state["accepted"] += 1
+            return 200, self._headers(state)
+
+    def counters(self):
+        with self._state.update() as state:
+            return state["accepted"], state["rejected"]
+
+
+def make(tmp):
+    api = RateLimitedStandIn(Path(tmp) / "standin.json", RPM, TPM, WINDOW)
+    scheduler = RateLimitScheduler(Path(tmp) / "scheduler.json", RPM, TPM, window=WINDOW)
+    return api, scheduler
+
+
+def call(api, scheduler, priority, latencies):
+    tokens = random.randint(200, 800)
+    start = time.monotonic()
+    while True:
+        reserved = scheduler.acquire(tokens, priority)
+        status, headers = api.create(tokens)
+        if status == 429:
+            scheduler.settle(reserved, 0)
+            scheduler.record_rate_limited(headers)
+            continue
+        scheduler.update_from_headers(headers)
+        scheduler.settle(reserved, tokens)
+        latencies.append(time.monotonic() - start)
+        return
+
+
+def bulk_process(tmp, stop, results):
+    api, scheduler = make(tmp)
+    latencies = []
+
+    def worker():
+        while not stop.is_set():
+            call(api, scheduler, Priority.BULK, latencies)
+
+    threads = [threading.Thread(target=worker) for _ in range(BULK_WORKERS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    results.put(latencies)
+
+
+def summary(name, values):
+    values = sorted(values)
+    if not values:
+        print(f"  {name:<12} no requests")
+        return
+    p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+    print(f"  {name:<12} n={len(values):<4} mean={sum(values) / len(values):.2f}s p95={p95:.2f}s")
+
+
+def main():
+    print(f"🚦 Rate limiter demo: {BULK_WORKERS} bulk workers (separate process) vs 1 interactive user")
+    print("=" * 50)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        api, scheduler = make(tmp)
+        stop = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        bulk = multiprocessing.Process(target=bulk_process, args=(tmp, stop, results))
+        bulk.start()
+
+        time.sleep(1.0)  # let bulk work saturate the budget first
+        interactive_latencies = []
+        for _ in range(15):
+            call(api, scheduler, Priority.INTERACTIVE, interactive_latencies)
+            time.sleep(0.4)
+
+        stop.set()
+        bulk_latencies = results.get()
+        bulk.join()
+
+        print("\nEnd-to-end latency per priority:")
+        summary("interactive", interactive_latencies)
+        summary("bulk", bulk_latencies)
+
+        print("\nScheduler queue-wait metrics (both processes):")
+        for name, stats in scheduler.metrics()["wait"].items():
+            print(f"  {name:<12} {stats}")
+
+        accepted, rejected = api.counters()
+        print(f"\nStand-in accepted={accepted} rejected(429)={rejected}")
+
+
+if __name__ == "__main__":
+    main()
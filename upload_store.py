@@ -0,0 +1,321 @@
+# upload_store.py
+"""
+Content-addressed store for uploaded images.
+
+Uploads are hashed once on ingest (while being copied into the store) and
+deduplicated by SHA-256. Each blob lives next to its derived artifacts:
+
+    <root>/<id[4:6]>/<id>/blob         original bytes
+    <root>/<id[4:6]>/<id>/preview.jpg  downscaled variant (needs Pillow)
+    <root>/<id[4:6]>/<id>/meta.json    hash, size, mime, EXIF, leases, ...
+
+Tools receive the opaque image ID instead of a file path, so later pipeline
+stages read the prepared variant without re-hashing or re-guessing anything.
+Each upload holds a lease on its entry for the duration of the request.
+Leases carry an expiry time, so a process killed before releasing cannot
+pin an entry forever. Entries without a live lease are evicted least
+recently used first once the disk quota is exceeded.
+
+The client and the MCP servers run as separate processes, so all metadata
+updates go through a store-wide file lock, which also guards a running
+total of stored bytes. Hashing and preview generation happen before the
+lock is taken; the full scan for eviction only runs when over quota.
+"""
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from shared_state import BASE_DIR, SharedState
+
+try:
+    from PIL import ExifTags, Image, ImageOps
+except ImportError:
+    Image = None
+
+ID_PREFIX = "img_"
+_ID_RE = re.compile(r"^img_[0-9a-f]{32}$")
+_CHUNK_SIZE = 1024 * 1024
+PREVIEW_MAX_SIDE = 1024
+
+
+class StoreQuotaExceeded(Exception):
+    """Raised when leased images alone exceed the disk quota."""
+
+
+def is_image_id(value: str) -> bool:
+    return bool(_ID_RE.match(value.strip()))
+
+
+# ------------------------------------------------------------------
+# DERIVED ARTIFACTS
+# ------------------------------------------------------------------
+def _extract_exif(img) -> Dict[str, str]:
+    exif = {}
+    for tag, value in img.getexif().items():
+        if isinstance(value, bytes):
+            continue
+        exif[str(ExifTags.TAGS.get(tag, tag))] = str(value)[:200]
+    return exif
+
+
+def _derive(blob_path: Path, entry_dir: Path, meta: Dict[str, Any]) -> None:
+    """
+    Adds dimensions, EXIF and a downscaled preview. Best effort: without
+    Pillow, or for formats it cannot open, the original blob is used as is.
+    """
+    if Image is None:
+        return
+    try:
+        with Image.open(blob_path) as original:
+            meta["exif"] = _extract_exif(original)
+            # Phone photos are often stored sideways with an Orientation tag;
+            # the preview is what the vision model sees, so bake it in.
+            img = ImageOps.exif_transpose(original)
+            meta["width"], meta["height"] = img.size
+            if max(img.size) > PREVIEW_MAX_SIDE:
+                img.thumbnail((PREVIEW_MAX_SIDE, PREVIEW_MAX_SIDE))
+                preview = entry_dir / "preview.jpg"
+                img.convert("RGB").save(preview, "JPEG", quality=85)
+                meta["preview"] = preview.name
+                meta["preview_size"] = preview.stat().st_size
+    except Exception as e:
+        meta["derive_error"] = str(e)
+
+
+# ------------------------------------------------------------------
+# STORE
+# ------------------------------------------------------------------
+class UploadStore:
+    def __init__(self, root: Path, quota_bytes: int, lease_ttl: float = 900.0):
+        self.root = Path(root)
+        self.quota_bytes = quota_bytes
+        self.lease_ttl = lease_ttl
+        self.root.mkdir(parents=True, exist_ok=True)
+        # Running total of stored bytes; its lock is the store-wide lock for
+        # all metadata updates. A missing file (first start, or a store
+        # written before it existed) is rebuilt from a full scan.
+        self._usage = SharedState(self.root / "usage.json", lambda: {"bytes": self._scan()[1]})
+        # Lease IDs this process took per image; release() drops one.
+        self._held: Dict[str, List[str]] = {}
+        self._held_lock = threading.Lock()
+
+    def _entry_dir(self, image_id: str) -> Path:
+        return self.root / image_id[4:6] / image_id
+
+    def _read_meta(self, image_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._entry_dir(image_id) / "meta.json", "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_meta(self, meta: Dict[str, Any]) -> None:
+        entry_dir = self._entry_dir(meta["id"])
+        tmp = entry_dir / "meta.json.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp, entry_dir / "meta.json")
+
+    def _add_lease(self, meta: Dict[str, Any]) -> None:
+        now = time.time()
+        # Expired leases belong to processes that died without releasing.
+        leases = {k: v for k, v in meta.get("leases", {}).items() if v > now}
+        lease_id = uuid.uuid4().hex
+        leases[lease_id] = now + self.lease_ttl
+        meta["leases"] = leases
+        with self._held_lock:
+            self._held.setdefault(meta["id"], []).append(lease_id)
+
+    @staticmethod
+    def _is_leased(meta: Dict[str, Any], now: float) -> bool:
+        return any(expires > now for expires in meta.get("leases", {}).values())
+
+    @staticmethod
+    def _entry_bytes(meta: Dict[str, Any]) -> int:
+        return meta["size"] + meta.get("preview_size", 0)
+
+    def _reuse(self, image_id: str) -> bool:
+        """
+        Takes a lease on an existing entry. Call with the store lock held.
+        """
+        meta = self._read_meta(image_id)
+        if meta is None:
+            return False
+        self._add_lease(meta)
+        meta["last_used"] = time.time()
+        self._write_meta(meta)
+        return True
+
+    def put_file(self, src_path: str) -> str:
+        """
+        Ingests a file and returns its image ID with one lease held.
+        The file is read exactly once: hashing happens while copying. The
+        preview is derived before the store lock is taken, so a slow decode
+        never blocks other uploads or the vision server.
+        """
+        digest = hashlib.sha256()
+        staging = Path(tempfile.mkdtemp(dir=self.root, prefix=".ingest-"))
+        size = 0
+        try:
+            with open(src_path, "rb") as src, open(staging / "blob", "wb") as dst:
+                for chunk in iter(lambda: src.read(_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    dst.write(chunk)
+                    size += len(chunk)
+
+            image_id = ID_PREFIX + digest.hexdigest()[:32]
+            with self._usage.update():
+                # Duplicate upload: keep the stored copy.
+                if self._reuse(image_id):
+                    return image_id
+
+            mime_type, _ = mimetypes.guess_type(src_path)
+            meta = {
+                "id": image_id,
+                "sha256": digest.hexdigest(),
+                "size": size,
+                "mime_type": mime_type or "image/jpeg",
+                "original_name": os.path.basename(src_path),
+                "created": time.time(),
+                "leases": {},
+            }
+            _derive(staging / "blob", staging, meta)
+
+            with self._usage.update() as usage:
+                # Another process may have stored the same image meanwhile.
+                if self._reuse(image_id):
+                    return image_id
+                entry_dir = self._entry_dir(image_id)
+                entry_dir.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(staging, entry_dir)
+                meta["last_used"] = time.time()
+                self._add_lease(meta)
+                self._write_meta(meta)
+                usage["bytes"] += self._entry_bytes(meta)
+                if usage["bytes"] > self.quota_bytes:
+                    usage["bytes"] = self._evict(keep=image_id)
+                over_quota = usage["bytes"] > self.quota_bytes
+                if over_quota:
+                    used = usage["bytes"]
+                    self._forget(image_id)
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                    usage["bytes"] -= self._entry_bytes(meta)
+            # Raised outside the block so the usage total is written back.
+            if over_quota:
+                raise StoreQuotaExceeded(
+                    f"Upload store would use {used} bytes, quota is {self.quota_bytes} bytes"
+                )
+            return image_id
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def resolve(self, image_id: str) -> Dict[str, Any]:
+        """
+        Returns the metadata plus "path"/"mime_type" of the variant to send
+        to the vision model (the downscaled preview when one exists).
+        """
+        image_id = image_id.strip()
+        with self._usage.update():
+            meta = self._read_meta(image_id)
+            if meta is None:
+                raise KeyError(f"Unknown image ID {image_id}")
+            meta["last_used"] = time.time()
+            self._write_meta(meta)
+
+        entry_dir = self._entry_dir(image_id)
+        if meta.get("preview"):
+            meta["path"] = str(entry_dir / meta["preview"])
+            meta["mime_type"] = "image/jpeg"
+        else:
+            meta["path"] = str(entry_dir / "blob")
+        return meta
+
+    def _forget(self, image_id: str) -> Optional[str]:
+        with self._held_lock:
+            held = self._held.get(image_id)
+            if not held:
+                return None
+            lease_id = held.pop()
+            if not held:
+                del self._held[image_id]
+            return lease_id
+
+    def release(self, image_id: str) -> None:
+        """
+        Drops one lease taken by this process. Entries without live leases
+        stay cached for future duplicate uploads until the quota forces
+        them out.
+        """
+        lease_id = self._forget(image_id)
+        if lease_id is None:
+            return
+        with self._usage.update() as usage:
+            meta = self._read_meta(image_id)
+            if meta is None:
+                return
+            meta.get("leases", {}).pop(lease_id, None)
+            self._write_meta(meta)
+            if usage["bytes"] > self.quota_bytes:
+                usage["bytes"] = self._evict()
+
+    def _scan(self) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Reads every entry's metadata. Returns (entries, total bytes).
+        """
+        entries = []
+        for meta_path in self.root.glob("*/*/meta.json"):
+            try:
+                with open(meta_path, "r", encoding="utf-8") as f:
+                    entries.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return entries, sum(self._entry_bytes(m) for m in entries)
+
+    def _evict(self, keep: Optional[str] = None) -> int:
+        """
+        Evicts entries without a live lease, least recently used first, until
+        usage fits the quota. Returns the resulting usage in bytes. Only
+        called when the running total is over quota, since it scans the
+        whole store.
+        """
+        entries, used = self._scan()
+        if used <= self.quota_bytes:
+            return used
+        now = time.time()
+        evictable = sorted(
+            (m for m in entries if not self._is_leased(m, now) and m["id"] != keep),
+            key=lambda m: m["last_used"],
+        )
+        for meta in evictable:
+            shutil.rmtree(self._entry_dir(meta["id"]), ignore_errors=True)
+            used -= self._entry_bytes(meta)
+            if used <= self.quota_bytes:
+                break
+        return used
+
+
+_store: Optional[UploadStore] = None
+
+
+def get_store() -> UploadStore:
+    """
+    Returns the store shared by the client and the MCP servers, configured
+    from UPLOAD_STORE_DIR, UPLOAD_STORE_QUOTA_MB and UPLOAD_LEASE_TTL_S.
+    """
+    global _store
+    if _store is None:
+        _store = UploadStore(
+            root=Path(os.getenv("UPLOAD_STORE_DIR", BASE_DIR / ".upload_store")),
+            quota_bytes=int(os.getenv("UPLOAD_STORE_QUOTA_MB", "1024")) * 1024 * 1024,
+            lease_ttl=float(os.getenv("UPLOAD_LEASE_TTL_S", "900")),
+        )
+    return _store
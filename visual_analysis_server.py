@@ -1,46 +1,77 @@
 # visual_analysis_server.py
 import os
-import base64
 import mimetypes
+import time
 from pathlib import Path
-from openai import OpenAI
+import httpx
 from dotenv import load_dotenv
 from mcp.server.fastmcp import FastMCP
 import logging
 
+from image_ingest import IMAGE_PLACEHOLDER, build_vision_body, get_budget
+from rate_limiter import MAX_RETRIES, get_scheduler, retry_backoff
+from upload_store import get_store, is_image_id
+
 load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
 
 mcp = FastMCP("VisualAnalysisServer")
 
+# Budget reserved per vision call before real usage is known:
+# prompt + image tiles + max_output_tokens.
+VISION_TOKEN_ESTIMATE = int(os.getenv("VISION_TOKEN_ESTIMATE", "1200"))
+
+# How long a request may queue for in-flight byte budget before it is rejected.
+VISION_ADMISSION_TIMEOUT = float(os.getenv("VISION_ADMISSION_TIMEOUT", "30"))
+
+# Called directly rather than through the OpenAI SDK, which serializes the
+# whole JSON body (image included) in memory before sending.
+http_client = httpx.Client(timeout=120)
+
+
+def _output_text(data: dict) -> str:
+    """
+    Equivalent of the SDK's Response.output_text for a raw Responses API body.
+    """
+    parts = []
+    for item in data.get("output") or []:
+        for content in item.get("content") or []:
+            if content.get("type") == "output_text":
+                parts.append(content.get("text", ""))
+    return "".join(parts)
+
+
 @mcp.tool()
-def extract_main_topic_from_image(file_path: str) -> str:
+def extract_main_topic_from_image(image_id: str) -> str:
     """
     Loads an image and extracts the main identifiable topic/object/place/person.
+    Takes the image ID given in the user message (e.g. "img_3f2a...");
+    a plain file path is also accepted.
     Returns ONLY the topic name (no sentences, no extra text).
     Example: "Eiffel Tower", "Pyramids of Giza", "Taj Mahal"
     """
     try:
-        BASE_DIR = Path(__file__).parent.resolve()
-        image_path = (BASE_DIR / file_path).resolve()
-        if not image_path.is_file():
-            return f"Error: File does not exist at path {file_path}"
-
-        with open(image_path, "rb") as f:
-            image_data = f.read()
-
-        base64_image = base64.b64encode(image_data).decode("utf-8")
-        mime_type, _ = mimetypes.guess_type(image_path)
-        if not mime_type:
-            mime_type = "image/jpeg"
-
-        client = OpenAI(api_key=OPENAI_API_KEY)
+        if is_image_id(image_id):
+            # Already hashed and downscaled on upload; read the prepared variant.
+            try:
+                stored = get_store().resolve(image_id)
+            except KeyError:
+                return f"Error: Unknown image ID {image_id}"
+            image_path = Path(stored["path"])
+            mime_type = stored["mime_type"]
+        else:
+            BASE_DIR = Path(__file__).parent.resolve()
+            image_path = (BASE_DIR / image_id).resolve()
+            if not image_path.is_file():
+                return f"Error: File does not exist at path {image_id}"
+            mime_type, _ = mimetypes.guess_type(image_path)
+            if not mime_type:
+                mime_type = "image/jpeg"
 
-        image_data_url = f"data:{mime_type};base64,{base64_image}"
-
-        response = client.responses.create(
-            model="gpt-4.1-mini",
-            input=[
+        payload = {
+            "model": "gpt-4.1-mini",
+            "input": [
                 {
                     "role": "user",
                     "content": [
@@ -50,16 +81,64 @@ def extract_main_topic_from_image(file_path: str) -> str:
                         },
                         {
                             "type": "input_image",
-                            "image_url": image_data_url
+                            "image_url": IMAGE_PLACEHOLDER
                         }
                     ]
                 }
             ],
-            max_output_tokens=50
-        )
+            "max_output_tokens": 50
+        }
+        scheduler = get_scheduler()
+        for attempt in range(MAX_RETRIES + 1):
+            # Rate-limit slot first: the byte budget is only held while a body
+            # is actually being sent, never while queueing for the API.
+            reserved = scheduler.acquire(VISION_TOKEN_ESTIMATE)
+            try:
+                # The body is streamed from disk, base64-encoded chunk by chunk,
+                # so no full copy of the image is ever held in memory. A fresh
+                # stream is built for every attempt.
+                content_length, body = build_vision_body(str(image_path), mime_type, payload)
+                with get_budget().reserve(content_length, timeout=VISION_ADMISSION_TIMEOUT):
+                    response = http_client.post(
+                        f"{OPENAI_BASE_URL}/responses",
+                        content=body,
+                        headers={
+                            "Authorization": f"Bearer {OPENAI_API_KEY}",
+                            "Content-Type": "application/json",
+                            "Content-Length": str(content_length),
+                        },
+                    )
+            except httpx.TransportError:
+                # Connection errors and timeouts: retried like the SDK did.
+                scheduler.settle(reserved, 0)
+                if attempt == MAX_RETRIES:
+                    raise
+                time.sleep(retry_backoff(attempt))
+                continue
+            except BaseException:
+                scheduler.settle(reserved, 0)
+                raise
+
+            if response.status_code == 429:
+                scheduler.settle(reserved, 0)
+                scheduler.record_rate_limited(response.headers)
+                if attempt < MAX_RETRIES:
+                    continue
+            elif response.status_code >= 500:
+                scheduler.settle(reserved, 0)
+                if attempt < MAX_RETRIES:
+                    time.sleep(retry_backoff(attempt))
+                    continue
+            elif not response.is_success:
+                scheduler.settle(reserved, 0)
+            response.raise_for_status()
+            break
 
+        scheduler.update_from_headers(response.headers)
+        data = response.json()
+        scheduler.settle(reserved, (data.get("usage") or {}).get("total_tokens"))
 
-        topic = response.output_text.strip()
+        topic = _output_text(data).strip()
         return topic
 
     except Exception as e: